@@ -34,6 +34,8 @@ class Animal(CellAgent): #We initalise an Animal class, which inherits from Mesa
         return self.symbiotic_property + self.random.uniform(-self.mutation_effectiveness, self.mutation_effectiveness) if self.random.random() <= self.mutation_chance else self.symbiotic_property
         
     def reproduce(self): #This is the reproduction function which is the default way of creating agents for our subclasses 
+        if not self.model.has_room(self.__class__, self.cell): #No offspring if the cell or the model is full, the parent keeps its energy
+            return
         self.energy /= 2 #We halve the energy so we don't get overrun by agents
         self.__class__( 
             model = self.model,
@@ -154,7 +156,7 @@ class Spider(Animal): #We initialise the Spider class which inherits from the An
         eggs_in_nest_amount = len(cells_with_egg.cells) #Checks the amount of cells with eggs in them
         max_eggs_in_nest = 16 #Sets max amount of eggs in the nest to 16 
         
-        if eggs_in_nest_amount < max_eggs_in_nest and len([egg for egg in self.cell.agents if isinstance(egg, SpiderEgg)]) == 0: #checks if it can lay an egg and lays one if it may
+        if eggs_in_nest_amount < max_eggs_in_nest and len([egg for egg in self.cell.agents if isinstance(egg, SpiderEgg)]) == 0 and self.model.has_room(SpiderEgg, self.cell): #checks if it can lay an egg and lays one if it may
             SpiderEgg.create_agents(
                 self.model,
                 1,
@@ -328,6 +330,8 @@ class SpiderEgg(CellAgent): #This is the SpiderEgg Agent which cannot move but h
         return len(nearby_ants) > 0
 
     def hatch(self): #hatches a spider agent
+        if not self.model.has_room(Spider, self.cell, freed=1): #The egg makes room for the spider, if there is still no room the egg is lost
+            return
         Spider.create_agents(
                 self.model,
                 1, 
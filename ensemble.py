@@ -0,0 +1,132 @@
+import os
+from functools import partial
+from multiprocessing import Pool
+
+from model import SymbioticRelationshipsModel
+
+
+class SymbioticEnsemble:
+    """Runs several seeds of one configuration in lockstep within a single process, so on one core.
+
+    The replicates share one GridLayout (neighbour table, coordinates, nest table and zone map). Each replicate
+    only holds its own agents, its own random generator from its seed and the grid cells its agents have visited,
+    which are created on first use.
+    """
+    def __init__(self, seeds, **params):
+        self.seeds = list(seeds)
+        self.replicates = []
+        layout = None
+        for seed in self.seeds:
+            model = SymbioticRelationshipsModel(seed=seed, layout=layout, **params)
+            layout = model.layout #The first replicate builds the layout from the model defaults, the others reuse it
+            self.replicates.append(model)
+
+    @property
+    def running(self): #The ensemble keeps going as long as one of the replicates does
+        return any(model.running for model in self.replicates)
+
+    def step(self): #Advances every replicate that is still running by one step
+        for model in self.replicates:
+            if model.running:
+                model.step()
+
+    def run(self, steps):
+        for _ in range(steps):
+            if not self.running:
+                break
+            self.step()
+
+    def results(self, first_replicate=0):
+        """Model level data of all replicates as one list of rows, indexed by replicate and step."""
+        rows = []
+        for replicate, (seed, model) in enumerate(zip(self.seeds, self.replicates), start=first_replicate):
+            data = model.datacollector.model_vars
+            for step in range(len(data["Ants"])):
+                rows.append({
+                    "Replicate": replicate,
+                    "Seed": seed,
+                    "Step": step,
+                    **{name: values[step] for name, values in data.items()},
+                })
+        return rows
+
+
+def _run_chunk(chunk, steps, params):
+    first_replicate, seeds = chunk
+    ensemble = SymbioticEnsemble(seeds, **params)
+    ensemble.run(steps)
+    return ensemble.results(first_replicate)
+
+
+def run_ensemble(seeds, steps, processes=1, **params):
+    """Runs the seeds split into one ensemble per process and returns the rows of all replicates.
+
+    Each process builds its own layout and steps its share of the seeds in lockstep. processes=None uses all CPUs.
+    """
+    seeds = list(seeds)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(seeds)))
+
+    # Contiguous chunks so the replicate numbers follow the order of the seeds
+    size, extra = divmod(len(seeds), processes)
+    chunks = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append((start, seeds[start:end]))
+        start = end
+
+    run_chunk = partial(_run_chunk, steps=steps, params=params)
+    if processes == 1:
+        return run_chunk(chunks[0])
+    with Pool(processes) as pool:
+        return [row for rows in pool.map(run_chunk, chunks) for row in rows]
+
+
+def measure_setup(seeds, **params):
+    """Setup time and memory of a standalone model and of each extra seed in an ensemble."""
+    import time
+    import tracemalloc
+
+    def timed(build):
+        start = time.perf_counter()
+        build()
+        return time.perf_counter() - start
+
+    def traced(build):
+        tracemalloc.start()
+        built = build()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del built
+        return memory
+
+    build_standalone = lambda: SymbioticRelationshipsModel(seed=seeds[0], **params)
+    build_ensemble = lambda: SymbioticEnsemble(seeds, **params)
+
+    build_standalone() #Warm up so the first measurement does not include one off costs
+    standalone_time = timed(build_standalone) #Time and memory are measured separately because tracing slows everything down
+    ensemble_time = timed(build_ensemble)
+    standalone_memory = traced(build_standalone)
+    ensemble_memory = traced(build_ensemble)
+
+    extra_seeds = len(seeds) - 1
+    return {
+        "standalone_time": standalone_time,
+        "standalone_memory": standalone_memory,
+        "extra_seed_time": (ensemble_time - standalone_time) / extra_seeds,
+        "extra_seed_memory": (ensemble_memory - standalone_memory) / extra_seeds,
+    }
+
+
+if __name__ == '__main__':
+    # Prints how much an extra seed in an ensemble costs compared to a standalone model
+    for grid_size in (32, 64, 128):
+        result = measure_setup(list(range(10)), grid_size=grid_size)
+        print(
+            f"grid {grid_size}: standalone {result['standalone_time'] * 1000:.1f} ms {result['standalone_memory'] / 1024:.0f} KiB, "
+            f"extra seed {result['extra_seed_time'] * 1000:.1f} ms {result['extra_seed_memory'] / 1024:.0f} KiB "
+            f"({result['extra_seed_time'] / result['standalone_time']:.0%} of the time, "
+            f"{result['extra_seed_memory'] / result['standalone_memory']:.0%} of the memory)"
+        )
@@ -1,12 +1,175 @@
 from mesa import Model
 from mesa.datacollection import DataCollector
 from mesa.experimental.devs import ABMSimulator
-from mesa.discrete_space import OrthogonalMooreGrid
+from mesa.discrete_space import Cell, CellCollection, OrthogonalMooreGrid
+from mesa.discrete_space.grid import Grid, pickle_gridcell
+from functools import cached_property
+import copyreg
 import math
 import numpy as np
 from agents import *
 
 
+class GridLayout:
+    """The neighbour table, spider nests and zone map of a grid, these never change during a run."""
+    def __init__(self, neighbours, spider_nests, zones, nest_size):
+        self.neighbours = neighbours
+        self.coordinates = list(neighbours) #In the same order as grid.all_cells, so drawing from it uses the random numbers the same way
+        self.spider_nests = spider_nests
+        self.zones = zones
+        self.nest_size = nest_size
+
+
+_cell_connections = Cell.__dict__["connections"] #The slot that stores the connections of a mesa Cell
+
+
+class PrewiredCell(Cell):
+    """Cell of a PrewiredGrid, it looks up its connections in the shared neighbour table the first time they are needed."""
+    _grid_cells = None #Set on the cell class of each grid
+    _neighbours = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _cell_connections.__set__(self, None) #Not wired yet
+
+    @property
+    def connections(self):
+        connections = _cell_connections.__get__(self)
+        if connections is None:
+            offsets, neighbours = self._neighbours[self.coordinate]
+            connections = dict(zip(offsets, map(self._grid_cells.__getitem__, neighbours)))
+            _cell_connections.__set__(self, connections)
+        return connections
+
+    @connections.setter
+    def connections(self, connections):
+        _cell_connections.__set__(self, connections)
+
+
+class CountingCell(PrewiredCell):
+    """Cell that keeps the number of agents of each type on it, so the species capacity is checked without scanning the agents."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.type_counts = {}
+
+    def add_agent(self, agent): #Every move goes through add_agent and remove_agent, so the counts stay correct for moving agents too
+        super().add_agent(agent)
+        agent_type = type(agent)
+        self.type_counts[agent_type] = self.type_counts.get(agent_type, 0) + 1
+
+    def remove_agent(self, agent):
+        super().remove_agent(agent)
+        self.type_counts[type(agent)] -= 1
+
+
+class _LazyCells(dict):
+    """The cells of a PrewiredGrid, a cell is only created the first time it is looked up."""
+    def __init__(self, grid):
+        super().__init__()
+        self.grid = grid
+
+    def __missing__(self, coordinate):
+        grid = self.grid
+        if coordinate not in grid.neighbours:
+            raise KeyError(coordinate)
+        cell = self[coordinate] = grid.cell_klass(coordinate, grid.capacity, random=grid.random)
+        return cell
+
+
+class PrewiredGrid(OrthogonalMooreGrid):
+    """OrthogonalMooreGrid that creates its cells on first use and wires them from a shared neighbour table.
+
+    Creating and wiring every cell is most of the cost of building a grid. Here a replicate of an ensemble only
+    pays for the cells its agents actually visit, the topology itself is shared through the table.
+    """
+    def __init__(self, dimensions, neighbours, torus=False, capacity=None, random=None, cell_klass=PrewiredCell):
+        # This follows Grid.__init__ of mesa 3.2, except that no cells are created or connected up front
+        super(Grid, self).__init__(capacity=capacity, random=random, cell_klass=cell_klass)
+        self.torus = torus
+        self.dimensions = dimensions
+        self._try_random = True
+        self._ndims = len(dimensions)
+        self._validate_parameters()
+        self.neighbours = neighbours
+        self._cells = _LazyCells(self)
+        self.cell_klass = type(
+            "GridCell",
+            (self.cell_klass,),
+            {"_mesa_properties": set(), "_grid_cells": self._cells, "_neighbours": neighbours},
+        )
+        copyreg.pickle(self.cell_klass, pickle_gridcell)
+        self.create_property_layer("empty", default_value=True, dtype=bool)
+
+    def _connect_cells_2d(self): #Cells connect themselves when their connections are first used
+        pass
+
+    @cached_property
+    def all_cells(self): #Creates every cell, in the same order as OrthogonalMooreGrid
+        cells = self._cells
+        return CellCollection({cells[coordinate]: cells[coordinate]._agents for coordinate in self.neighbours}, random=self.random)
+
+    def __iter__(self):
+        return iter(self.all_cells)
+
+
+def build_neighbour_table(height, width):
+    """For every coordinate the offsets of its neighbours and their coordinates, in the order OrthogonalMooreGrid connects them."""
+    # Same offsets in the same order as OrthogonalMooreGrid, the spider relies on the neighbourhood indexing
+    offsets = (
+        (-1, -1), (-1, 0), (-1, 1),
+        ( 0, -1),          ( 0, 1),
+        ( 1, -1), ( 1, 0), ( 1, 1),
+    )
+    coordinates = [[(i, j) for j in range(width)] for i in range(height)] #Neighbours reuse these tuples instead of making new ones
+    edge_offsets = {} #Cells along the same edge share one offsets tuple
+
+    table = {}
+    for i in range(height):
+        row = coordinates[i]
+        for j in range(width):
+            if 0 < i < height - 1 and 0 < j < width - 1:
+                valid = offsets
+            else:
+                valid = tuple((di, dj) for di, dj in offsets if 0 <= i + di < height and 0 <= j + dj < width)
+                valid = edge_offsets.setdefault(valid, valid)
+            table[row[j]] = (valid, tuple(coordinates[i + di][j + dj] for di, dj in valid))
+    return table
+
+
+def build_grid_layout(grid_size, nest_density, nest_size=3):
+    width = grid_size
+    height = grid_size
+    spider_nests = {}
+
+    margin = nest_size  # distance from walls to keep free
+    x0 = margin
+    y0 = margin
+    x1 = width - margin
+    y1 = height - margin
+    nest_spacing = 1 - nest_density
+    dx = int(width * nest_spacing)
+    dy = int(height * nest_spacing)
+
+    nest_count = 0
+    #Store nests in dictionary so we can track where each nest is located
+    for x in range(x0, x1, dx):
+        for y in range(y0, y1, dy):
+            nest_count += 1
+
+            nx = x - nest_size // 2
+            ny = y - nest_size // 2
+            spider_nests[f"nest{nest_count}"] = (nx, ny)
+
+    # Mark spider nests, only the cells under each nest are visited instead of the whole grid
+    zones = {}
+    for nest_name, nest_location in spider_nests.items():
+        for x in range(max(nest_location[0], 0), min(nest_location[0] + nest_size, width)):
+            for y in range(max(nest_location[1], 0), min(nest_location[1] + nest_size, height)):
+                zones[(x, y)] = nest_name
+
+    return GridLayout(build_neighbour_table(height, width), spider_nests, zones, nest_size)
+
+
 class SymbioticRelationshipsModel(Model):
     def __init__(
         self,
@@ -23,10 +186,19 @@ class SymbioticRelationshipsModel(Model):
         p_reproduce_frog=0.04,
         p_reproduce_spider=0.04,
         ant_spawn_rate = 2, #The amount of ants we spawn into the model
+        cell_capacity=None, #Max agents on one cell when spawning, reproducing or hatching, None means no limit
+        species_capacity=None, #Max agents of one species on one cell when spawning, reproducing or hatching, None means no limit
+        max_agents=None, #Global agent budget, no new agents are added while the model holds this many, None means no limit
         simulator: ABMSimulator = None, #Our Agent based model simulator
+        layout=None, #A GridLayout shared with other replicates, built from grid_size and nest_density if not given
     ):
         super().__init__(seed=seed, rng=rng)
         self.ant_spawn_rate = ant_spawn_rate #sets parameters like ant spawnrate and sumlator
+        self.cell_capacity = cell_capacity
+        self.species_capacity = species_capacity
+        self.max_agents = max_agents
+        self.capacity_limited = cell_capacity is not None or species_capacity is not None or max_agents is not None
+        self.cap_hits = {"cell": 0, "species": 0, "budget": 0} #How often each cap stopped an agent from being added
         if simulator is None:
             simulator = ABMSimulator()
 
@@ -35,69 +207,31 @@ class SymbioticRelationshipsModel(Model):
 
         self.height = grid_size
         self.width = grid_size
-        nest_density = 1 - nest_density
+        # The grid wiring, nest tables and zone map only depend on the grid size and nest density, so an ensemble can share one layout between its replicates
+        if layout is None:
+            layout = build_grid_layout(grid_size, nest_density)
+        self.layout = layout
         # Create grid using experimental cell space
-        self.grid = OrthogonalMooreGrid(
+        self.grid = PrewiredGrid(
             [self.height, self.width],
+            layout.neighbours,
             torus=False,  #We want to illustrate a real world environment so we chose to keep torus on false which lets nests in corners thrive
             capacity=math.inf, #Spiders need to be able to move over their nests
             random=self.random,
+            cell_klass=CountingCell if species_capacity is not None else PrewiredCell, #Counting costs a little on every move, so only when it is needed
         )
         
-        # Create nest zone mapping for tracking
-        self.zones = {}
-
-        self.spider_nests = {}
-        self.spider_nest_size = 3
-
-        margin = self.spider_nest_size  # distance from walls to keep free
-        x0 = margin
-        y0 = margin
-        x1 = self.width - margin
-        y1 = self.height - margin
-        dx = int(self.width * nest_density)
-        dy = int(self.height * nest_density)
-
-        nest_count = 0
-        #Store nests in dictionary so we can track where each nest is located
-        for x in range(x0, x1, dx):
-            for y in range(y0, y1, dy):
-                nest_count += 1
-
-                nx = x - self.spider_nest_size // 2
-                ny = y - self.spider_nest_size // 2
-                self.spider_nests[f"nest{nest_count}"] = (nx, ny)
-        
-        for cell in self.grid.all_cells.cells:
-            x, y = cell.coordinate
-
-            # Mark spider nests
-            for nest_name, nest_location in self.spider_nests.items():
-                start_nest_x = nest_location[0]
-                end_nest_x = nest_location[0] + self.spider_nest_size
-                start_nest_y = nest_location[1]
-                end_nest_y = nest_location[1] + self.spider_nest_size
-                if (
-                    x >= start_nest_x
-                    and x < end_nest_x
-                    and y >= start_nest_y
-                    and y < end_nest_y
-                ):
-                    self.zones[(x, y)] = nest_name
+        self.spider_nests = layout.spider_nests
+        self.zones = layout.zones
+        self.spider_nest_size = layout.nest_size
 
         # Spawn spiders on their nests
         for nest_name, nest_location in self.spider_nests.items():
-            Spider.create_agents(
-                self,
-                1,  
+            self.place_agents(
+                Spider,
                 nest=(nest_name, nest_location),
-                cell=self.random.choices(
-                    [
-                        cell
-                        for cell in self.grid.all_cells.cells
-                        if cell.coordinate[0] == nest_location[0] + 1
-                        and cell.coordinate[1] == nest_location[1] + 1
-                    ],
+                cells=self.random.choices(
+                    [self.grid[(nest_location[0] + 1, nest_location[1] + 1)]],
                     k=1,
                 ), 
                 p_reproduce=p_reproduce_spider,
@@ -105,46 +239,46 @@ class SymbioticRelationshipsModel(Model):
 
         # Set up data collection
         model_reporters = {
-            "Spiders": lambda m: len(m.agents_by_type[Spider]),
-            "Frogs": lambda m: len(m.agents_by_type[Frog]),
-            "Ants": lambda m: len(m.agents_by_type[Ant]),
-            "Snakes": lambda m: len(m.agents_by_type[Snake]),
+            "Spiders": lambda m: len(m.agents_by_type.get(Spider, [])),
+            "Frogs": lambda m: len(m.agents_by_type.get(Frog, [])),
+            "Ants": lambda m: len(m.agents_by_type.get(Ant, [])),
+            "Snakes": lambda m: len(m.agents_by_type.get(Snake, [])),
             "Spider_Symb_Val": lambda m: np.mean(
                 np.fromiter(
-                    (spider.symbiotic_property for spider in m.agents_by_type[Spider]), #calculates average symbiotic property
+                    (spider.symbiotic_property for spider in m.agents_by_type.get(Spider, [])), #calculates average symbiotic property
                     dtype=float,
                 )
             ),
             "Frog_Symb_Val": lambda m: np.mean(
                 np.fromiter(
-                    (frog.symbiotic_property for frog in m.agents_by_type[Frog]),
+                    (frog.symbiotic_property for frog in m.agents_by_type.get(Frog, [])),
                     dtype=float,
                 )
             ),
+            "Cell_Cap_Hits": lambda m: m.cap_hits["cell"],
+            "Species_Cap_Hits": lambda m: m.cap_hits["species"],
+            "Budget_Cap_Hits": lambda m: m.cap_hits["budget"],
         }
 
         self.datacollector = DataCollector(model_reporters)
 
-        Frog.create_agents( #spawn agents on grid
-            self,
-            initial_frogs,  
-            cell=self.random.choices(self.grid.all_cells.cells, k=initial_frogs),
+        self.place_agents( #spawn agents on grid
+            Frog,
+            cells=self.random_cells(initial_frogs),
             p_reproduce=p_reproduce_frog,
             # symbiotic_property = self.random.random()*2-1 
             symbiotic_property = 0
         )
 
-        Snake.create_agents(
-            self,
-            initial_snakes, 
-            cell=self.random.choices(self.grid.all_cells.cells, k=initial_snakes),
+        self.place_agents(
+            Snake,
+            cells=self.random_cells(initial_snakes),
             p_reproduce=p_reproduce_snake,
         )
 
-        Ant.create_agents(
-            self,
-            initial_ants,  
-            cell=self.random.choices(self.grid.all_cells.cells, k=initial_ants),
+        self.place_agents(
+            Ant,
+            cells=self.random_cells(initial_ants),
             p_reproduce=p_reproduce_ant,
         )
 
@@ -155,12 +289,39 @@ class SymbioticRelationshipsModel(Model):
     def get_zone_at(self, x, y):
         return self.zones.get((x, y), "unmarked")
 
+    #returns k cells drawn with replacement, like random.choices over grid.all_cells but only creating the cells that are drawn
+    def random_cells(self, k):
+        return [self.grid[coordinate] for coordinate in self.random.choices(self.layout.coordinates, k=k)]
+
+    #creates an agent of agent_type on each of the cells, with carrying capacities only the agents that fit are placed so the model never starts over budget
+    def place_agents(self, agent_type, cells, **kwargs):
+        if not self.capacity_limited:
+            agent_type.create_agents(self, len(cells), cell=cells, **kwargs)
+            return
+        for cell in cells:
+            if self.has_room(agent_type, cell):
+                agent_type(self, cell=cell, **kwargs)
+
+    #returns if an agent of agent_type may be added to cell under the carrying capacities, freed is the number of agents leaving the cell at the same time (a hatching egg)
+    def has_room(self, agent_type, cell, freed=0):
+        if not self.capacity_limited:
+            return True
+        if self.max_agents is not None and len(self.agents) - freed >= self.max_agents: #Cheapest check first, the agent count is kept by mesa
+            self.cap_hits["budget"] += 1
+            return False
+        if self.cell_capacity is not None and len(cell.agents) - freed >= self.cell_capacity:
+            self.cap_hits["cell"] += 1
+            return False
+        if self.species_capacity is not None and cell.type_counts.get(agent_type, 0) >= self.species_capacity:
+            self.cap_hits["species"] += 1
+            return False
+        return True
+
     def step(self): #Activates the step sequence
         """Execute one step of the model."""
-        self.agents_by_type[Ant].shuffle_do("step")
-        self.agents_by_type[Snake].shuffle_do("step")
-        self.agents_by_type[Frog].shuffle_do("step")
-        self.agents_by_type[Spider].shuffle_do("step")
+        for agent_type in (Ant, Snake, Frog, Spider):
+            if agent_type in self.agents_by_type: #A species is missing when the carrying capacities kept all of it off the grid
+                self.agents_by_type[agent_type].shuffle_do("step")
         try:#Only activates if there is an egg on the grid
             self.agents_by_type[SpiderEgg].shuffle_do("step")
         except:
@@ -171,7 +332,6 @@ class SymbioticRelationshipsModel(Model):
 
         # Spawn ants every 2 ticks
         if self.steps % 2 == 0:
-            Ant.create_agents(
-                self, self.ant_spawn_rate, cell=self.random.choices(self.grid.all_cells.cells, k=self.ant_spawn_rate)  
-            )  
+            cells = self.random_cells(self.ant_spawn_rate)
+            self.place_agents(Ant, cells) #With caps the ants are added one by one so each one sees the occupancy left by the previous ones
        
\ No newline at end of file
@@ -0,0 +1,185 @@
+import time
+_start_time = time.perf_counter() #Taken before any other import so the reported import time covers everything below
+import argparse
+import json
+import os
+import sys
+
+# Headless entry point for quick experiments and sweeps. Only the model is imported up front,
+# pandas is imported when results are written and nothing from server.py (solara, matplotlib) is ever loaded.
+# Note that mesa itself still imports pandas and scipy in its package __init__, so that part of the cost cannot be avoided here.
+
+MODEL_PARAMS = { #Model parameters that can be set from the command line, with the type used to parse them
+    "grid_size": int,
+    "initial_frogs": int,
+    "initial_ants": int,
+    "initial_snakes": int,
+    "mutation_rate": float,
+    "nest_density": float,
+    "seed": int,
+    "p_reproduce_ant": float,
+    "p_reproduce_snake": float,
+    "p_reproduce_frog": float,
+    "p_reproduce_spider": float,
+    "ant_spawn_rate": int,
+    "cell_capacity": int,
+    "species_capacity": int,
+    "max_agents": int,
+}
+
+CONFIG_KEYS = ("parameters", "steps", "iterations", "processes", "collect_every", "replicates", "output") #Top level keys of the config file
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the symbiotic relationships model without the GUI. "
+        "Parameters given as a list in the config file are swept over with mesa's batch_run."
+    )
+    parser.add_argument("--config", help="JSON file with model parameters and run options")
+    parser.add_argument("--steps", type=int, default=None, help="Number of steps per run (default 1000)")
+    parser.add_argument("--iterations", type=int, default=None, help="Iterations per parameter combination in a sweep (default 1)")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes, 0 uses all CPUs (default 1 for a sweep, all CPUs for an ensemble like batch_run.py)")
+    parser.add_argument("--collect-every", type=int, default=None, help="Data collection period in a sweep, -1 collects only at the end (default 1)")
+    parser.add_argument("--replicates", type=int, default=None, help="Run this many seeds, counting up from --seed, in lockstep, split over --processes (default 1)")
+    parser.add_argument("--output", default=None, help="CSV file to write the results to, nothing is written if omitted")
+    for name, param_type in MODEL_PARAMS.items():
+        parser.add_argument("--" + name.replace("_", "-"), dest=name, type=param_type, default=None)
+    return parser.parse_args(argv)
+
+
+def load_config(args):
+    """Combine the config file with the command line, command line values win."""
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        unknown = sorted(set(config) - set(CONFIG_KEYS))
+        if unknown:
+            sys.exit(f"Unknown keys in {args.config}: {', '.join(unknown)}. Allowed keys are {', '.join(CONFIG_KEYS)}")
+
+    params = dict(config.get("parameters", {}))
+    unknown = sorted(set(params) - set(MODEL_PARAMS))
+    if unknown:
+        sys.exit(f"Unknown model parameters in {args.config}: {', '.join(unknown)}. Allowed parameters are {', '.join(MODEL_PARAMS)}")
+    for name in MODEL_PARAMS:
+        value = getattr(args, name)
+        if value is not None:
+            params[name] = value
+
+    options = {
+        "steps": config.get("steps", 1000),
+        "iterations": config.get("iterations", 1),
+        "processes": config.get("processes"), #None when not given, the default depends on the kind of run
+        "collect_every": config.get("collect_every", 1),
+        "replicates": config.get("replicates", 1),
+        "output": config.get("output"),
+    }
+    for name in options:
+        value = getattr(args, name)
+        if value is not None:
+            options[name] = value
+    return params, options
+
+
+def ensemble_seeds(params, options):
+    """The seeds of an ensemble run, taken from a seed list or counted up from a single seed."""
+    seed = params.pop("seed", 0)
+    if isinstance(seed, list):
+        if len(seed) != options["replicates"]:
+            sys.exit(f"The seed list has {len(seed)} seeds but {options['replicates']} replicates were asked for")
+        return seed
+    if seed is None:
+        seed = 0
+    return list(range(seed, seed + options["replicates"]))
+
+
+def is_sweep(params, options):
+    return options["iterations"] > 1 or any(isinstance(value, list) for value in params.values())
+
+
+def run_single(model, steps):
+    """Run one model for a number of steps and return its model level data as a list of rows."""
+    for _ in range(steps):
+        if not model.running:
+            break
+        model.step()
+    data = model.datacollector.model_vars
+    return [
+        {"Step": step, **{name: values[step] for name, values in data.items()}}
+        for step in range(len(data["Ants"]))
+    ]
+
+
+def run_sweep(model_cls, params, options):
+    from mesa.batchrunner import batch_run
+
+    return batch_run(
+        model_cls,
+        parameters=params,
+        iterations=options["iterations"],
+        max_steps=options["steps"],
+        data_collection_period=options["collect_every"],
+        number_processes=1 if options["processes"] is None else options["processes"] or None, #0 means use all the threads, like batch_run.py does
+        display_progress=False,
+    )
+
+
+def write_output(results, path):
+    import pandas as pd #Only needed when we actually write something
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    pd.DataFrame(results).to_csv(path)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    params, options = load_config(args)
+
+    from model import SymbioticRelationshipsModel
+    import_time = time.perf_counter() - _start_time
+
+    setup_time = None #Stays None when the setup happens in worker processes and cannot be measured here
+    run_start = time.perf_counter()
+    if options["replicates"] > 1:
+        from ensemble import SymbioticEnsemble, run_ensemble
+
+        seeds = ensemble_seeds(params, options)
+        if any(isinstance(value, list) for value in params.values()):
+            sys.exit("An ensemble runs one configuration, only the seed can be a list")
+        if options["iterations"] != 1:
+            sys.exit("An ensemble runs every seed once, use --replicates instead of --iterations")
+        if options["collect_every"] != 1:
+            sys.exit("An ensemble collects data every step, --collect-every cannot be used with --replicates")
+        processes = 0 if options["processes"] is None else options["processes"] #Spread the replicates over all CPUs unless asked otherwise
+        if processes == 1:
+            ensemble = SymbioticEnsemble(seeds, **params)
+            setup_time = time.perf_counter() - run_start
+            ensemble.run(options["steps"])
+            results = ensemble.results()
+        else:
+            results = run_ensemble(seeds, options["steps"], processes=processes or None, **params)
+    elif is_sweep(params, options):
+        results = run_sweep(SymbioticRelationshipsModel, params, options)
+    else:
+        model = SymbioticRelationshipsModel(**params)
+        setup_time = time.perf_counter() - run_start #Time until the model is ready for step 1
+        results = run_single(model, options["steps"])
+    run_time = time.perf_counter() - run_start - (setup_time or 0.0)
+
+    if options["output"]:
+        write_output(results, options["output"])
+    total_time = time.perf_counter() - _start_time
+
+    setup = "n/a" if setup_time is None else f"{setup_time:.3f}s" #For sweeps and multi-process ensembles the setup is part of the run time
+    print(
+        f"import {import_time:.3f}s, setup {setup}, run {run_time:.3f}s, total {total_time:.3f}s, {len(results)} rows",
+        file=sys.stderr,
+    )
+    if not options["output"] and results:
+        print(json.dumps(results[-1], default=float)) #Without an output file we still show the final state
+
+
+if __name__ == '__main__':
+    main()